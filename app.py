@@ -1,170 +1,530 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+from collections import defaultdict
+from functools import partial
+from importlib.util import find_spec
 from io import BytesIO
+from pandas.api.types import union_categoricals
+import pyarrow as pa
+from pyarrow import csv as pa_csv
 import altair as alt
+import codecs
 import time
 
-# Ensure openpyxl is available
+# Raw rows written to the optional Excel sheet; the full data is offered as Parquet/CSV
+RAW_SHEET_MAX_ROWS = 500000
+
+# Column types for the parsed log. Repetitive columns (endpoints, methods, hosts,
+# client IPs, user agents) are categorical and applied by the CSV parser as it reads;
+# numeric columns are read as strings and cast per chunk, so one bad value does not
+# fail the upload. Any column not listed (query strings, referers, ...) is read as
+# Arrow-backed strings instead of one Python object per cell
+LOG_DTYPES = {
+    's-port': 'Int32',
+    'sc-status': 'Int16',
+    'sc-substatus': 'Int32',
+    'sc-win32-status': 'Int64',
+    'sc-bytes': 'Int64',
+    'cs-bytes': 'Int64',
+    'time-taken': 'Int32',
+    'cs-uri-stem': 'category',
+    'cs-method': 'category',
+    'cs-host': 'category',
+    'cs-version': 'category',
+    's-ip': 'category',
+    's-sitename': 'category',
+    's-computername': 'category',
+    'c-ip': 'category',
+    'cs(User-Agent)': 'category',
+}
+
+# Numba is optional; without it the endpoint x status aggregation uses NumPy reductions
 try:
-    import openpyxl
+    import numba
+    # Streamlit runs each session's script on its own thread, so the parallel kernel can
+    # be entered concurrently. The default workqueue layer aborts the process on that,
+    # and TBB hangs the interpreter at exit when first launched off the main thread;
+    # OpenMP handles both
+    numba.config.THREADING_LAYER = 'omp'
 except ImportError:
-    st.error("Please install 'openpyxl' using: `pip install openpyxl`")
-    st.stop()
+    numba = None
+
+# Shared chart styling, registered once instead of configured on every chart
+@alt.theme.register('iis_log_analyzer', enable=True)
+def iis_log_analyzer_theme():
+    return {
+        'config': {
+            'axis': {'labelFontSize': 12, 'titleFontSize': 14},
+            'title': {'fontSize': 16, 'color': '#333'}
+        }
+    }
+
+def convert_numeric_columns(chunk):
+    """Cast the chunk's numeric columns to their LOG_DTYPES types, coercing bad or out-of-range values to NA."""
+    for col, dtype in LOG_DTYPES.items():
+        if col not in chunk or dtype == 'category':
+            continue
+        try:
+            chunk[col] = chunk[col].astype(dtype)
+        except (ValueError, TypeError, pa.ArrowInvalid):
+            # Only a chunk holding a non-numeric or oversized value takes this slower path
+            numbers = pd.to_numeric(chunk[col], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+            limits = np.iinfo(dtype.lower())
+            numbers[(numbers < limits.min) | (numbers > limits.max) | (numbers % 1 != 0)] = np.nan
+            chunk[col] = pd.Series(numbers, index=chunk.index).astype(dtype)
+    return chunk
+
+def finish_log_rows(chunk):
+    """Cast numeric columns and add seconds and datetime columns to a parsed chunk."""
+    chunk = convert_numeric_columns(chunk)
+    
+    # Convert time-taken to seconds; float32 keeps millisecond precision at half the bandwidth
+    chunk['time-taken'] = chunk['time-taken'].astype('Float32') / 1000.0
+    
+    # Create datetime column from the few distinct dates plus the (at most 86,400)
+    # distinct times, without building a concatenated 'date time' string per row
+    dates = pd.to_datetime(chunk['date'], format='%Y-%m-%d', errors='coerce', cache=True)
+    time_codes, times = pd.factorize(chunk['time'], use_na_sentinel=False)
+    chunk['datetime'] = dates + pd.to_timedelta(times, errors='coerce').to_numpy()[time_codes]
+    return chunk
 
-def parse_iis_log(file_content, chunk_size=1000):
-    """Parse IIS log file content into a DataFrame with chunked processing."""
+def concat_log_chunks(chunks, fields):
+    """Concatenate parsed chunks, merging each categorical column's per-chunk categories."""
+    if not chunks:
+        return pd.DataFrame()
+    # Each chunk has its own categories; merge them before concatenating so the
+    # columns stay categorical instead of falling back to strings
+    categorical = [col for col in fields if isinstance(chunks[0][col].dtype, pd.CategoricalDtype)]
+    merged = {}
+    for col in categorical:
+        parts = [chunk.pop(col) for chunk in chunks]
+        # A chunk where the column is all '-' has empty object categories, which
+        # union_categoricals refuses to merge with the other chunks' str categories
+        parts = [part.cat.set_categories(part.cat.categories.astype('str')) for part in parts]
+        merged[col] = union_categoricals(parts, sort_categories=True)
+    df = pd.concat(chunks, ignore_index=True)
+    for col in categorical:
+        df.insert(fields.index(col), col, merged[col])
+    return df
+
+def read_log_arrow(log_file, fields):
+    """Read the log body with PyArrow's streaming CSV reader; return the rows and the skipped line count."""
+    # The reader reads ahead on a background thread and keeps going after it raises,
+    # so give it its own view of the remaining bytes rather than the shared file
+    # position, which the pandas fallback seeks back on
+    if hasattr(log_file, 'getbuffer'):
+        source = pa.BufferReader(pa.py_buffer(log_file.getbuffer()[log_file.tell():]))
+    else:
+        source = pa.BufferReader(log_file.read())
+    
+    skipped = 0
+    
+    def skip_invalid_row(row):
+        nonlocal skipped
+        # Directive lines repeated mid-file (e.g. after an app pool restart) and
+        # whitespace-only lines are not data, as in the pandas parser
+        if row.text.startswith('#') or not row.text.strip():
+            return 'skip'
+        # A line with doubled, trailing or tab separators is well-formed to the C
+        # parser; fail the read so the whole file is parsed there instead
+        if len(row.text.split()) == len(fields):
+            return 'error'
+        skipped += 1
+        return 'skip'
+    
+    categorical = {col for col, dtype in LOG_DTYPES.items() if dtype == 'category'}
+    # Stream 8 MB blocks so peak memory stays close to the chunked pandas parser's
+    reader = pa_csv.open_csv(
+        source,
+        read_options=pa_csv.ReadOptions(column_names=fields, block_size=1 << 23),
+        parse_options=pa_csv.ParseOptions(delimiter=' ', quote_char=False, invalid_row_handler=skip_invalid_row),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={
+                col: pa.dictionary(pa.int32(), pa.string()) if col in categorical else pa.string()
+                for col in fields
+            },
+            null_values=['-', ''],
+            strings_can_be_null=True
+        )
+    )
+    # Map to the same Arrow-backed strings the pandas parser produces
+    pandas_types = {pa.string(): pd.StringDtype('pyarrow')}
+    chunks = []
+    for batch in reader:
+        chunk = batch.to_pandas(types_mapper=pandas_types.get)
+        # A directive with exactly as many words as there are fields parses as a row
+        directive = chunk[fields[0]].str.startswith('#').fillna(False).to_numpy(dtype=bool)
+        if directive.any():
+            chunk = chunk[~directive].reset_index(drop=True)
+        chunks.append(finish_log_rows(chunk))
+    return concat_log_chunks(chunks, fields), skipped
+
+def read_log_chunks(log_file, fields):
+    """Read the log body with pandas' python parser in chunks; return the rows and the skipped line count."""
+    skipped = 0
+    
+    def skip_long_line(fields):
+        """Count and drop a line with more fields than the #Fields header."""
+        nonlocal skipped
+        skipped += 1
+        return None
+    
+    # Directive lines repeated mid-file (e.g. after an app pool restart) are comments
+    reader = pd.read_csv(
+        log_file,
+        sep=r'\s+',
+        engine='python',
+        names=fields,
+        header=None,
+        comment='#',
+        # Short lines are padded with empty values; '-' is left literal in the last
+        # column so the padding there tells them apart from a logged '-'
+        na_values={col: ['-', ''] if col != fields[-1] else [''] for col in fields},
+        keep_default_na=False,
+        dtype=defaultdict(lambda: 'string[pyarrow]', {col: dtype for col, dtype in LOG_DTYPES.items() if dtype == 'category'}),
+        on_bad_lines=skip_long_line,
+        encoding='utf-8',
+        encoding_errors='ignore',
+        chunksize=200000,
+    )
+    
+    # Finish each chunk's conversions while it is small, so the temporaries they
+    # allocate are bounded by the chunk size rather than the file size
+    chunks = []
+    for chunk in reader:
+        padded = chunk[fields[-1]].isna()
+        if padded.any():
+            skipped += int(padded.sum())
+            chunk = chunk[~padded].copy()
+        last = chunk[fields[-1]]
+        chunk[fields[-1]] = last.mask((last == '-').fillna(False))
+        chunks.append(finish_log_rows(chunk))
+    return concat_log_chunks(chunks, fields), skipped
+
+def parse_iis_log(log_file):
+    """Parse an IIS log file object into a DataFrame using PyArrow's CSV reader, or pandas' python parser as a fallback."""
     try:
-        lines = file_content.decode('utf-8', errors='ignore').splitlines()
+        # Read directive lines up to the #Fields: header; the file is left
+        # positioned on the first data line. Directives precede the data, so stop at
+        # the first other line, and read at most 8 KB of each so a misuploaded file
+        # without line breaks fails fast instead of being read whole
+        log_file.seek(0)
         fields = None
-        data = []
+        for line in iter(lambda: log_file.readline(8192), b''):
+            # IIS writes a UTF-8 byte order mark ahead of the first directive
+            line = line.removeprefix(codecs.BOM_UTF8)
+            if line.startswith(b'#Fields:'):
+                fields = line[len(b'#Fields:'):].decode('utf-8', errors='ignore').split()
+                break
+            if not line.startswith(b'#') and line.strip():
+                break
+        if not fields:
+            raise ValueError("Invalid IIS log format or no data found")
         required_fields = {'date', 'time', 'sc-status', 'time-taken', 'cs-uri-stem'}
+        if not required_fields.issubset(fields):
+            missing = required_fields - set(fields)
+            raise ValueError(f"Missing required fields: {missing}")
         
-        # Progress bar for parsing
-        progress_bar = st.progress(0)
-        total_lines = len(lines)
+        # PyArrow tokenizes on every core but rejects the whole file on invalid UTF-8
+        # and splits on single spaces only. The chunked pandas parser drops undecodable bytes
+        # and splits on any whitespace, so retry with it from the first data line when
+        # the fast read fails, including on any line only whitespace splitting accepts.
+        # Bad numeric values do not fail either reader; they become NA per chunk
+        data_start = log_file.tell()
+        try:
+            df, skipped = read_log_arrow(log_file, fields)
+        except pa.ArrowInvalid:
+            log_file.seek(data_start)
+            df, skipped = read_log_chunks(log_file, fields)
         
-        for i, line in enumerate(lines):
-            if line.startswith('#'):
-                if line.startswith('#Fields:'):
-                    fields = line.split()[1:]
-                    if not required_fields.issubset(fields):
-                        missing = required_fields - set(fields)
-                        raise ValueError(f"Missing required fields: {missing}")
-                continue
-            if fields and line.strip():
-                row = line.split()
-                if len(row) == len(fields):
-                    data.append(row)
-                else:
-                    st.warning(f"Skipping malformed line {i+1}: {line[:50]}... (expected {len(fields)} fields, got {len(row)})")
-            
-            # Update progress every chunk
-            if i % chunk_size == 0 or i == total_lines - 1:
-                progress_bar.progress(min((i + 1) / total_lines, 1.0))
+        if skipped:
+            st.warning(f"Skipped {skipped} malformed lines (field count does not match the #Fields header)")
         
-        if not fields or not data:
+        if df.empty:
             raise ValueError("Invalid IIS log format or no data found")
         
-        df = pd.DataFrame(data, columns=fields)
-        
-        # Convert numeric columns
-        numeric_cols = ['s-port', 'sc-status', 'sc-substatus', 'sc-win32-status', 'sc-bytes', 'cs-bytes', 'time-taken']
-        for col in numeric_cols:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-        
-        # Convert time-taken to seconds
-        if 'time-taken' in df.columns:
-            df['time-taken'] = df['time-taken'] / 1000.0
-        
-        # Create datetime column
-        if 'date' in df.columns and 'time' in df.columns:
-            df['datetime'] = pd.to_datetime(df['date'] + ' ' + df['time'], errors='coerce')
-            if df['datetime'].isna().all():
-                st.error("Failed to parse 'date' and 'time' columns. Ensure they are in 'YYYY-MM-DD HH:MM:SS' format.")
-                st.stop()
+        if df['datetime'].isna().all():
+            raise ValueError("Failed to parse 'date' and 'time' columns. Ensure they are in 'YYYY-MM-DD HH:MM:SS' format.")
         
-        progress_bar.empty()
         return df
     except Exception as e:
-        progress_bar.empty()
         raise ValueError(f"Error parsing log file: {str(e)}")
 
-def generate_summary(df):
+def accumulate_cells_numpy(keys, times, n_cells):
+    """Accumulate size/count/sum/min/max of times per cell key with NumPy reductions."""
+    timed = ~np.isnan(times)
+    timed_keys, timed_times = keys[timed], times[timed]
+    size = np.bincount(keys, minlength=n_cells)
+    count = np.bincount(timed_keys, minlength=n_cells)
+    total = np.bincount(timed_keys, weights=timed_times, minlength=n_cells)
+    low = np.full(n_cells, np.inf)
+    np.minimum.at(low, timed_keys, timed_times)
+    high = np.full(n_cells, -np.inf)
+    np.maximum.at(high, timed_keys, timed_times)
+    return size, count, total, low, high
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def accumulate_cells_in_blocks(keys, times, n_cells, n_blocks):
+        """Accumulate size/count/sum/min/max of times per cell key, one block of rows per thread."""
+        # Each block fills its own partial grid so threads never contend on a cell
+        block_len = (keys.size + n_blocks - 1) // n_blocks
+        size = np.zeros((n_blocks, n_cells), np.int64)
+        count = np.zeros((n_blocks, n_cells), np.int64)
+        total = np.zeros((n_blocks, n_cells), np.float64)
+        low = np.full((n_blocks, n_cells), np.inf)
+        high = np.full((n_blocks, n_cells), -np.inf)
+        for block in numba.prange(n_blocks):
+            for i in range(block * block_len, min((block + 1) * block_len, keys.size)):
+                key = keys[i]
+                value = times[i]
+                size[block, key] += 1
+                if not np.isnan(value):
+                    count[block, key] += 1
+                    total[block, key] += value
+                    low[block, key] = min(low[block, key], value)
+                    high[block, key] = max(high[block, key], value)
+        
+        # Reduce the partial grids cell by cell
+        for cell in numba.prange(n_cells):
+            for block in range(1, n_blocks):
+                size[0, cell] += size[block, cell]
+                count[0, cell] += count[block, cell]
+                total[0, cell] += total[block, cell]
+                low[0, cell] = min(low[0, cell], low[block, cell])
+                high[0, cell] = max(high[0, cell], high[block, cell])
+        return size[0], count[0], total[0], low[0], high[0]
+
+    def accumulate_cells_numba(keys, times, n_cells):
+        """Accumulate size/count/sum/min/max of times per cell key across all Numba threads."""
+        try:
+            # Cap the block count so the partial grids hold no more cells than there are rows.
+            # The thread count is read here, not in the kernel, so the kernel can be cached.
+            n_blocks = max(1, min(numba.get_num_threads(), keys.size // max(n_cells, 1)))
+            return accumulate_cells_in_blocks(keys, times, n_cells, n_blocks)
+        except ValueError:
+            # The OpenMP threading layer could not be loaded
+            return accumulate_cells_numpy(keys, times, n_cells)
+
+# Use the parallel Numba kernel when Numba is installed, else the NumPy reductions
+accumulate_cells = accumulate_cells_numba if numba is not None else accumulate_cells_numpy
+
+def aggregate_by_endpoint_status(df):
+    """Aggregate response times per (endpoint, status) pair in a single pass over category codes."""
+    endpoints = df['cs-uri-stem'].cat.categories
+    endpoint_codes = df['cs-uri-stem'].cat.codes.to_numpy().astype(np.int64)
+    missing_endpoint = endpoint_codes < 0
+    if missing_endpoint.any():
+        # Requests logged without an endpoint still count toward their status; keep
+        # them in a '-' bucket, as the log writes them
+        if '-' not in endpoints:
+            endpoints = endpoints.append(pd.Index(['-'], dtype=endpoints.dtype))
+        endpoint_codes[missing_endpoint] = endpoints.get_loc('-')
+    status_codes, statuses = pd.factorize(df['sc-status'], sort=True)
+    valid = status_codes >= 0
+    
+    # Flatten each (endpoint, status) cell of the endpoint x status grid to one integer key
+    n_cells = len(endpoints) * len(statuses)
+    keys = endpoint_codes[valid] * len(statuses) + status_codes[valid]
+    # Aggregate whole milliseconds so results carry no float32 noise (0.966 -> 0.96600002);
+    # float32 still holds every millisecond count up to about 4.6 hours exactly
+    times = np.rint(df['time-taken'].to_numpy(dtype='float64', na_value=np.nan)[valid] * 1000).astype(np.float32)
+    size, count, total, low, high = accumulate_cells(keys, times, n_cells)
+    
+    cells = np.flatnonzero(size)
+    index = pd.MultiIndex.from_arrays(
+        [pd.Categorical.from_codes(cells // len(statuses), categories=endpoints), statuses.take(cells % len(statuses))],
+        names=['cs-uri-stem', 'sc-status']
+    )
+    no_times = count[cells] == 0
+    # Sums stay in milliseconds so re-aggregating them stays exact; means divide last
+    return pd.DataFrame({
+        'size': size[cells],
+        'count': count[cells],
+        'sum_ms': total[cells],
+        'min': np.where(no_times, np.nan, low[cells] / 1000.0),
+        'max': np.where(no_times, np.nan, high[cells] / 1000.0)
+    }, index=index)
+
+def generate_summary(stats):
     """Generate summary statistics by status code."""
-    summary = df.groupby('sc-status').agg(
-        count=('sc-status', 'size'),
-        avg_time=('time-taken', 'mean'),
-        max_time=('time-taken', 'max'),
-        min_time=('time-taken', 'min')
-    ).reset_index()
-    summary.columns = ['Status Code', 'Request Count', 'Avg Response Time (sec)', 'Max Response Time (sec)', 'Min Response Time (sec)']
+    by_status = stats.groupby(level='sc-status', observed=True).agg(
+        {'size': 'sum', 'count': 'sum', 'sum_ms': 'sum', 'max': 'max', 'min': 'min'}
+    )
+    summary = pd.DataFrame({
+        'Status Code': by_status.index,
+        'Request Count': by_status['size'].to_numpy(),
+        'Avg Response Time (sec)': (by_status['sum_ms'] / by_status['count'] / 1000.0).to_numpy(),
+        'Max Response Time (sec)': by_status['max'].to_numpy(),
+        'Min Response Time (sec)': by_status['min'].to_numpy()
+    })
     return summary
 
-def create_pivot_table(df):
+def create_pivot_table(stats):
     """Create pivot table of requests by endpoint and status."""
-    pivot = pd.pivot_table(
-        df,
-        values='time-taken',
-        index='cs-uri-stem',
-        columns='sc-status',
-        aggfunc=['count', 'mean', 'max'],
-        fill_value=0
-    )
+    pivot = stats[['count']].assign(mean=stats['sum_ms'] / stats['count'] / 1000.0, max=stats['max'])
+    pivot = pivot.unstack('sc-status', fill_value=0).fillna(0)
     pivot.columns = [f"{func}_Status_{status}" for func, status in pivot.columns]
     return pivot.reset_index()
 
-def get_error_apps(df):
+def get_error_apps(stats):
     """Summarize errors (status >= 500) by endpoint."""
-    errors = df[df['sc-status'] >= 500]
+    errors = stats[stats.index.get_level_values('sc-status') >= 500]
     if not errors.empty:
-        error_summary = errors.groupby('cs-uri-stem').agg(
-            error_count=('sc-status', 'size'),
-            avg_time=('time-taken', 'mean'),
-            max_time=('time-taken', 'max')
-        ).reset_index()
-        error_summary.columns = ['Endpoint', 'Error Count', 'Avg Response Time (sec)', 'Max Response Time (sec)']
+        # Fold the error cells onto their endpoints with bincount rather than a groupby
+        codes, endpoints = pd.factorize(errors.index.get_level_values('cs-uri-stem'), sort=True)
+        size = np.bincount(codes, weights=errors['size'].to_numpy(), minlength=len(endpoints))
+        count = np.bincount(codes, weights=errors['count'].to_numpy(), minlength=len(endpoints))
+        total = np.bincount(codes, weights=errors['sum_ms'].to_numpy(), minlength=len(endpoints))
+        # fmax skips cells whose times were all missing, as groupby's max does
+        high = np.full(len(endpoints), np.nan)
+        np.fmax.at(high, codes, errors['max'].to_numpy())
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count / 1000.0
+        error_summary = pd.DataFrame({
+            'Endpoint': endpoints,
+            'Error Count': size.astype(np.int64),
+            'Avg Response Time (sec)': np.where(count > 0, mean, np.nan),
+            'Max Response Time (sec)': high
+        })
         return error_summary
     return None
 
-def create_xlsx(summary_df, raw_df, pivot_df, error_df):
-    """Create Excel file with all tables."""
+def get_error_rows(df):
+    """Return the columns the error scatter plot needs for rows with status >= 500, in random order."""
+    rows = np.flatnonzero(df['sc-status'].to_numpy(dtype='int16', na_value=0) >= 500)
+    # Shuffle once per upload so any prefix is a uniform sample; charts take head(n)
+    # rather than drawing a fresh sample on every rerun
+    rows = np.random.default_rng(42).permutation(rows)
+    # Gather just these columns instead of copying every column of every matching row
+    columns = ['datetime', 'time-taken', 'sc-status', 'cs-uri-stem']
+    errors = pd.DataFrame({col: df[col].array.take(rows) for col in columns})
+    # Widen float32 seconds back to the logged milliseconds (4.474, not 4.473999977)
+    errors['time-taken'] = errors['time-taken'].astype('Float64').round(3)
+    return errors
+
+def get_hourly_counts(df):
+    """Count requests per hour of the datetime column."""
+    # Truncate to whole hours with a datetime64 cast and count with a sort-and-scan,
+    # instead of flooring into a new column and hash-grouping Timestamps
+    hours = df['datetime'].dropna().to_numpy().astype('datetime64[h]')
+    hours, counts = np.unique(hours, return_counts=True)
+    return pd.DataFrame({'hour': hours.astype('datetime64[s]'), 'Request Count': counts})
+
+@st.cache_data(show_spinner="Analyzing log file...", max_entries=4)
+def analyze_log(_log_file, file_id):
+    """Parse an uploaded log and build every derived table as one cache entry per upload."""
+    # Keyed on the upload's file_id, so reruns neither re-hash the file contents
+    # nor hash the parsed frames again on their way into downstream helpers
+    parse_start = time.time()
+    raw_df = parse_iis_log(_log_file)
+    parse_seconds = time.time() - parse_start
+    stats = aggregate_by_endpoint_status(raw_df)
+    return (
+        parse_seconds,
+        raw_df,
+        generate_summary(stats),
+        create_pivot_table(stats),
+        get_error_apps(stats),
+        get_error_rows(raw_df),
+        get_hourly_counts(raw_df)
+    )
+
+def write_excel_sheet(workbook, sheet_name, df, chunk_size=10000):
+    """Write a DataFrame to a new worksheet row by row, as constant_memory mode requires."""
+    worksheet = workbook.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, [str(col) for col in df.columns])
+    # float32 values widen to noisy doubles (0.966 -> 0.96600002), so round them back
+    float32_cols = {col: 6 for col in df.columns if df[col].dtype in ('float32', 'Float32')}
+    for start in range(0, len(df), chunk_size):
+        # Convert one chunk at a time to Python objects, with missing values as blank cells
+        chunk = df.iloc[start:start + chunk_size]
+        if float32_cols:
+            chunk = chunk.astype(dict.fromkeys(float32_cols, 'float64')).round(float32_cols)
+        chunk = chunk.astype(object)
+        chunk = chunk.where(chunk.notna(), None)
+        for offset, row in enumerate(chunk.itertuples(index=False, name=None)):
+            worksheet.write_row(start + offset + 1, 0, row)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def create_xlsx(_summary_df, _raw_df, _pivot_df, _error_df, file_id, include_raw_sheet):
+    """Create Excel file with all tables, streaming rows out in constant-memory mode."""
+    # Imported here so sessions that never download the report skip loading xlsxwriter
+    import xlsxwriter
+    
+    output = BytesIO()
+    options = {
+        'constant_memory': True,
+        'default_date_format': 'yyyy-mm-dd hh:mm:ss',
+        'strings_to_formulas': False,
+        'strings_to_urls': False
+    }
+    with xlsxwriter.Workbook(output, options) as workbook:
+        write_excel_sheet(workbook, 'Status Summary', _summary_df)
+        # The raw sheet dominates workbook build time, so it is opt-in and capped
+        if include_raw_sheet:
+            write_excel_sheet(workbook, 'Raw Data', _raw_df.head(RAW_SHEET_MAX_ROWS))
+        if _pivot_df is not None:
+            write_excel_sheet(workbook, 'Pivot Table', _pivot_df)
+        if _error_df is not None:
+            write_excel_sheet(workbook, 'Error Summary', _error_df)
+    return output.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def create_parquet(_raw_df, file_id):
+    """Serialize the raw log rows to zstd-compressed Parquet."""
+    output = BytesIO()
+    _raw_df.to_parquet(output, engine='pyarrow', compression='zstd', index=False)
+    return output.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def create_csv(_raw_df, file_id):
+    """Serialize the raw log rows to gzip-compressed CSV."""
     output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        summary_df.to_excel(writer, sheet_name='Status Summary', index=False)
-        raw_df.to_excel(writer, sheet_name='Raw Data', index=False)
-        if pivot_df is not None:
-            pivot_df.to_excel(writer, sheet_name='Pivot Table', index=False)
-        if error_df is not None:
-            error_df.to_excel(writer, sheet_name='Error Summary', index=False)
-    output.seek(0)
-    return output
-
-def create_status_bar_chart(df, color_scale):
-    """Create bar chart for status code distribution."""
-    status_counts = df['sc-status'].value_counts().reset_index()
-    status_counts.columns = ['Status', 'Count']
+    _raw_df.to_csv(output, index=False, compression='gzip')
+    return output.getvalue()
+
+def create_status_bar_chart(summary_df, color_scale):
+    """Create bar chart for status code distribution from the status summary."""
+    # The summary already holds one request count per status; no need to rescan the rows
+    status_counts = pd.DataFrame({
+        'Status': summary_df['Status Code'].to_numpy(dtype='int16'),
+        'Count': summary_df['Request Count'].to_numpy()
+    })
     chart = alt.Chart(status_counts).mark_bar().encode(
         x=alt.X('Status:O', title='Status Code'),
         y=alt.Y('Count:Q', title='Number of Requests'),
         color=alt.Color('Status:O', scale=color_scale),
         tooltip=['Status', 'Count']
-    ).properties(title="Status Code Distribution", width=400).configure_axis(
-        labelFontSize=12, titleFontSize=14
-    ).configure_title(fontSize=16, color='#333')
+    ).properties(title="Status Code Distribution", width=400)
     return chart
 
-def create_timeline_chart(df):
-    """Create line chart for requests over time."""
-    df['hour'] = df['datetime'].dt.floor('H')
-    timeline_data = df.groupby('hour').size().reset_index(name='Request Count')
+def create_timeline_chart(timeline_data):
+    """Create line chart for requests over time from pre-aggregated hourly counts."""
     chart = alt.Chart(timeline_data).mark_line(color='#2ca02c').encode(
         x=alt.X('hour:T', title='Time'),
         y=alt.Y('Request Count:Q', title='Number of Requests'),
         tooltip=['hour', 'Request Count']
-    ).properties(title="Requests Timeline (Hourly)", width=600).configure_axis(
-        labelFontSize=12, titleFontSize=14
-    ).configure_title(fontSize=16, color='#333')
+    ).properties(title="Requests Timeline (Hourly)", width=600)
     return chart
 
-def create_error_scatter_chart(df, status_filter, color_scale):
-    """Create scatter plot for error response times."""
-    errors = df[df['sc-status'] >= 500]
+def create_error_scatter_chart(errors, status_filter, color_scale, sample_size):
+    """Create scatter plot for error response times from pre-filtered error rows."""
     if status_filter:
         errors = errors[errors['sc-status'].isin(status_filter)]
     if not errors.empty:
-        # Sample to avoid Altair row limit
-        if len(errors) > 5000:
-            errors = errors.sample(5000, random_state=42)
+        # Rows arrive pre-shuffled, so the first sample_size rows are a uniform sample and
+        # the browser never receives more points than that
+        error_count = len(errors)
+        errors = errors.head(sample_size)
         chart = alt.Chart(errors).mark_circle().encode(
             x=alt.X('datetime:T', title='Time'),
             y=alt.Y('time-taken:Q', title='Response Time (sec)'),
             color=alt.Color('sc-status:O', scale=color_scale),
             tooltip=['datetime', 'time-taken', 'cs-uri-stem', 'sc-status']
-        ).properties(title="Error Response Times Timeline (sec)", width=600).configure_axis(
-            labelFontSize=12, titleFontSize=14
-        ).configure_title(fontSize=16, color='#333')
-        return chart, len(errors)
+        ).properties(title="Error Response Times Timeline (sec)", width=600)
+        return chart, error_count
     return None, 0
 
 def create_error_pie_chart(error_df):
@@ -174,9 +534,7 @@ def create_error_pie_chart(error_df):
             theta=alt.Theta('Error Count:Q', title='Error Count'),
             color=alt.Color('Endpoint:N', scale=alt.Scale(scheme='category20')),
             tooltip=['Endpoint', 'Error Count']
-        ).properties(title="Error Distribution by Endpoint", width=400).configure_axis(
-            labelFontSize=12, titleFontSize=14
-        ).configure_title(fontSize=16, color='#333')
+        ).properties(title="Error Distribution by Endpoint", width=400)
         return chart
     return None
 
@@ -189,6 +547,7 @@ st.sidebar.header("Configuration")
 sample_size = st.sidebar.slider("Sample Size for Visualizations", 1000, 10000, 5000, 1000)
 status_filter = st.sidebar.multiselect("Filter Error Status Codes", [500, 502, 503, 504], default=[500, 502, 503, 504])
 show_debug = st.sidebar.checkbox("Show Debug Logs", False)
+include_raw_sheet = st.sidebar.checkbox("Include Raw Data Sheet in Excel (slow for large files)", False)
 
 # File uploader
 uploaded_file = st.file_uploader("Upload IIS .log file", type=["log"])
@@ -196,29 +555,47 @@ uploaded_file = st.file_uploader("Upload IIS .log file", type=["log"])
 if uploaded_file:
     try:
         start_time = time.time()
-        raw_df = parse_iis_log(uploaded_file.read())
+        parse_seconds, raw_df, summary_df, pivot_df, error_df, errors_df, timeline_df = analyze_log(uploaded_file, uploaded_file.file_id)
         
         # Debug logs
         if show_debug:
             st.write("**Debug Info**")
-            st.write(f"Parsed {len(raw_df)} rows in {time.time() - start_time:.2f} seconds")
+            st.write(f"Parsed {len(raw_df)} rows in {parse_seconds:.2f} seconds")
+            # Reruns reuse the cached analysis, so this is a cache lookup after the first run
+            st.write(f"Analysis ready in {time.time() - start_time:.2f} seconds")
             st.write("Columns:", raw_df.columns.tolist())
             st.write("Sample data:", raw_df.head())
         
-        # Generate data
-        summary_df = generate_summary(raw_df)
-        pivot_df = create_pivot_table(raw_df) if 'cs-uri-stem' in raw_df.columns else None
-        error_df = get_error_apps(raw_df) if 'cs-uri-stem' in raw_df.columns else None
-        xlsx_output = create_xlsx(summary_df, raw_df, pivot_df, error_df)
+        # Exports are built only when their download button is clicked
+        if include_raw_sheet and len(raw_df) > RAW_SHEET_MAX_ROWS:
+            st.warning(
+                f"The Excel 'Raw Data' sheet holds the first {RAW_SHEET_MAX_ROWS:,} of {len(raw_df):,} rows. "
+                "Use the Parquet or CSV download for every row."
+            )
         
         st.success("Log file processed successfully!")
         
-        # Download button
+        # Download buttons
+        if find_spec('xlsxwriter') is not None:
+            st.download_button(
+                label="Download Excel Report",
+                data=partial(create_xlsx, summary_df, raw_df, pivot_df, error_df, uploaded_file.file_id, include_raw_sheet),
+                file_name="IIS_log_analysis.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+        else:
+            st.error("Please install 'xlsxwriter' using: `pip install xlsxwriter` to download the Excel report")
+        st.download_button(
+            label="Download Raw Data (Parquet)",
+            data=partial(create_parquet, raw_df, uploaded_file.file_id),
+            file_name="IIS_log_raw.parquet",
+            mime="application/vnd.apache.parquet"
+        )
         st.download_button(
-            label="Download Excel Report",
-            data=xlsx_output,
-            file_name="IIS_log_analysis.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            label="Download Raw Data (CSV, gzip)",
+            data=partial(create_csv, raw_df, uploaded_file.file_id),
+            file_name="IIS_log_raw.csv.gz",
+            mime="application/gzip"
         )
         
         # Display tables
@@ -243,20 +620,20 @@ if uploaded_file:
         
         # Status Code Bar Chart
         if 'sc-status' in raw_df.columns:
-            st.altair_chart(create_status_bar_chart(raw_df, color_scale), use_container_width=True)
+            st.altair_chart(create_status_bar_chart(summary_df, color_scale), use_container_width=True)
         else:
             st.error("Cannot display status chart: 'sc-status' column missing.")
         
         # Requests Timeline
         if 'datetime' in raw_df.columns:
-            st.altair_chart(create_timeline_chart(raw_df), use_container_width=True)
+            st.altair_chart(create_timeline_chart(timeline_df), use_container_width=True)
         else:
             st.error("Cannot display timeline: 'datetime' column missing.")
         
         # Error Scatter Plot
         st.subheader("Error Response Times Timeline (sec)")
         if 'datetime' in raw_df.columns and 'time-taken' in raw_df.columns:
-            scatter_chart, error_count = create_error_scatter_chart(raw_df, status_filter, color_scale)
+            scatter_chart, error_count = create_error_scatter_chart(errors_df, status_filter, color_scale, sample_size)
             st.write(f"Found {error_count} error rows (status >= 500, filtered by {status_filter or 'all'})")
             if scatter_chart:
                 st.altair_chart(scatter_chart, use_container_width=True)